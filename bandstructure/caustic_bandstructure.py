@@ -42,17 +42,29 @@ class Bandstructure:
         self.r = [rx - np.mean(rx), ry - np.mean(ry)]
         self.dr = np.diff(self.r)
 
+        # Start and end points of each segment of the closed trajectory
+        self.rx0 = self.r[0][:-1]
+        self.ry0 = self.r[1][:-1]
+        self.rx1 = self.rx0 + self.dr[0]
+        self.ry1 = self.ry0 + self.dr[1]
+
     def calculate_injection_prob(self, normal_angle):
         '''
         computes the injection probabilities for a given state for
         an edge according to its normal angle
         '''
+        in_probs, cum_probs = self.calculate_injection_prob_batch([normal_angle])
+        return in_probs[0], cum_probs[0]
 
+    def calculate_injection_prob_batch(self, normal_angles):
+        '''
+        calculate_injection_prob for several edges at once, returns one row per normal angle
+        '''
         S = np.sqrt(self.dr[0]**2 + self.dr[1]**2)
         S_max = np.max(S)
         theta = np.arctan2(self.dr[1], self.dr[0])
 
-        prob = np.cos(theta - normal_angle) * S/S_max
-        prob = [0 if p < 0 else p for p in prob]
-        prob = prob/np.sum(prob)
-        return prob, np.cumsum(prob)
+        prob = np.cos(theta - np.asarray(normal_angles, dtype=np.float64)[:, None]) * S/S_max
+        prob = np.where(prob < 0, 0, prob)
+        prob = prob/np.sum(prob, axis=1, keepdims=True)
+        return prob, np.cumsum(prob, axis=1)
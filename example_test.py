@@ -1,3 +1,5 @@
+import os
+import tempfile
 import unittest
 
 import numpy as np
@@ -8,18 +10,166 @@ import monte_carlo_simulation as mcs
 
 
 class TestMCS(unittest.TestCase):
+    def setUp(self):
+        self.k = delafossite()
+        self.bar_frame = caustic_frame.Frame('geo/bar.dxf')
+
     def test_mcs(self):
-        k = delafossite()
-        bar_frame = caustic_frame.Frame('geo/bar.dxf')
         fields = np.linspace(10, 11, 2)
 
         for field in fields:
             np.random.seed(42)
-            bar_sim = mcs.Simulation(bar_frame, k, 0, field)
+            bar_sim = mcs.Simulation(self.bar_frame, self.k, 0, field)
             edge_to_collisions, trajectories = bar_sim.run_simulation(2)
             print(f'{field:.1f} T: {list(map(len, trajectories))}')
             self.assertEqual(len(trajectories), 2)
 
+    def test_mcs_stored_states_drop_error(self):
+        bar_sim = mcs.Simulation(self.bar_frame, self.k, 0, 10)
+        step_position = bar_sim._step_position
+
+        def step_position_with_error(n_f, x, y, debug=False):
+            step_params, line_crosses = step_position(n_f, x, y, debug)
+            return [(n_f, x, y, mcs.TrajectoryState.ERROR, None)] + step_params, line_crosses
+        bar_sim._step_position = step_position_with_error
+
+        for run in (bar_sim.run_simulation, bar_sim.run_simulation_batched):
+            np.random.seed(42)
+            _, trajectories = run(2)
+            states = {step[-2] for trajectory in trajectories for step in trajectory}
+            self.assertNotIn(mcs.TrajectoryState.ERROR, states)
+            self.assertIn(mcs.TrajectoryState.ABSORBED, states)
+
+            np.random.seed(42)
+            _, trajectories = run(
+                2, stored_states=mcs.ALL_STATES | {mcs.TrajectoryState.ERROR})
+            states = {step[-2] for trajectory in trajectories for step in trajectory}
+            self.assertIn(mcs.TrajectoryState.ERROR, states)
+
+    def test_mcs_cache(self):
+        bar_sim = mcs.Simulation(self.bar_frame, self.k, 0, 10)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'data') + os.sep
+            np.random.seed(42)
+            _, trajectories = bar_sim.run_simulation_with_cache(
+                'bar', 1, path=path)
+            self.assertTrue(os.path.isfile(path + 'bar.pkl'))
+
+            # A second call must load the stored result instead of simulating again
+            np.random.seed(0)
+            _, cached_trajectories = bar_sim.run_simulation_with_cache(
+                'bar', 1, path=path)
+            self.assertEqual(list(map(len, trajectories)),
+                             list(map(len, cached_trajectories)))
+
+    def test_mcs_parallel(self):
+        bar_sim = mcs.Simulation(self.bar_frame, self.k, 0, 10)
+        edge_to_collisions, trajectories = bar_sim.run_simulation_parallel(
+            3, n_workers=2, seed=42)
+        self.assertEqual(len(trajectories), 3)
+        self.assertEqual(set(edge_to_collisions),
+                         set(bar_sim._frame.edges))
+        for trajectory in trajectories:
+            self.assertIn(trajectory[0][-1], bar_sim._frame.edges)
+            self.assertEqual(trajectory[-1][-2], mcs.TrajectoryState.ABSORBED)
+
+    def test_mcs_set_seed(self):
+        bar_sim = mcs.Simulation(self.bar_frame, self.k, 0, 10)
+        bar_sim.set_seed(7)
+        edge_to_collisions, trajectories = bar_sim.run_simulation(2)
+        np.random.seed(0)
+        bar_sim.set_seed(7)
+        seeded_edge_to_collisions, seeded_trajectories = bar_sim.run_simulation(2)
+
+        self.assertEqual(edge_to_collisions, seeded_edge_to_collisions)
+        self.assertEqual(trajectories, seeded_trajectories)
+
+    def test_mcs_batched(self):
+        np.random.seed(42)
+        bar_sim = mcs.Simulation(self.bar_frame, self.k, 0, 10)
+        edge_to_collisions, trajectories = bar_sim.run_simulation_batched(
+            3, n_batch=2)
+        self.assertEqual(len(trajectories), 3)
+        for trajectory in trajectories:
+            self.assertEqual(trajectory[0][-2], mcs.TrajectoryState.INJECTING)
+            self.assertEqual(trajectory[-1][-2], mcs.TrajectoryState.ABSORBED)
+
+    def test_mcs_batched_matches_serial(self):
+        # With a single slot the batched run draws in the same order as the serial one
+        bar_sim = mcs.Simulation(self.bar_frame, self.k, 0, 10, p_scatter=0.5)
+        np.random.seed(42)
+        edge_to_collisions, trajectories = bar_sim.run_simulation(3)
+        np.random.seed(42)
+        batched_edge_to_collisions, batched_trajectories = bar_sim.run_simulation_batched(
+            3, n_batch=1)
+
+        self.assertEqual(edge_to_collisions, batched_edge_to_collisions)
+        self.assertEqual(list(map(len, trajectories)),
+                         list(map(len, batched_trajectories)))
+        for trajectory, batched_trajectory in zip(trajectories, batched_trajectories):
+            self.assertEqual(np.bincount([step[-2] for step in trajectory]).tolist(),
+                             np.bincount([step[-2] for step in batched_trajectory]).tolist())
+
+        # Debug mode steps every carrier through _step_position in both modes
+        np.random.seed(42)
+        debug_edge_to_collisions, debug_trajectories = bar_sim.run_simulation_batched(
+            3, n_batch=1, debug=True)
+        self.assertEqual(edge_to_collisions, debug_edge_to_collisions)
+        self.assertEqual(list(map(len, trajectories)),
+                         list(map(len, debug_trajectories)))
+
+    def test_mcs_batched_totals(self):
+        # Interleaved carriers draw in a different order, but every carrier still ends in
+        # exactly one absorption by the ground
+        n_inject = 5
+        bar_sim = mcs.Simulation(self.bar_frame, self.k, 0, 10, p_scatter=0.5)
+        np.random.seed(42)
+        edge_to_collisions, trajectories = bar_sim.run_simulation(n_inject)
+        np.random.seed(42)
+        batched_edge_to_collisions, batched_trajectories = bar_sim.run_simulation_batched(
+            n_inject, n_batch=3)
+
+        for counts, runs in ((edge_to_collisions, trajectories),
+                             (batched_edge_to_collisions, batched_trajectories)):
+            self.assertEqual(len(runs), n_inject)
+            self.assertEqual(sum(count for edge, count in counts.items() if edge.layer == 2),
+                             n_inject)
+            for trajectory in runs:
+                self.assertEqual(trajectory[-1][-2], mcs.TrajectoryState.ABSORBED)
+                self.assertEqual(trajectory[-1][-1].layer, 2)
+        self.assertEqual(set(edge_to_collisions), set(batched_edge_to_collisions))
+
+    def test_mcs_trajectory_arrays(self):
+        bar_sim = mcs.Simulation(self.bar_frame, self.k, 0, 10)
+        np.random.seed(42)
+        edge_to_collisions, trajectories = bar_sim.run_simulation(3)
+        np.random.seed(42)
+        array_edge_to_collisions, array_trajectories = bar_sim.run_simulation(
+            3, trajectory_arrays=True)
+
+        self.assertEqual(edge_to_collisions, array_edge_to_collisions)
+        self.assertEqual(len(array_trajectories), 3)
+        for trajectory, array_trajectory in zip(trajectories, array_trajectories):
+            self.assertEqual(array_trajectory.shape, (len(trajectory), 6))
+            for (n_f, x, y, state, edge), row in zip(trajectory, array_trajectory):
+                self.assertEqual(tuple(row), (n_f[0], n_f[1], x, y, state,
+                                              -1 if edge is None else edge.index))
+
+    def test_mcs_batched_trajectory_arrays(self):
+        bar_sim = mcs.Simulation(self.bar_frame, self.k, 0, 10)
+        np.random.seed(42)
+        _, trajectories = bar_sim.run_simulation_batched(3, n_batch=2)
+        np.random.seed(42)
+        _, array_trajectories = bar_sim.run_simulation_batched(
+            3, n_batch=2, trajectory_arrays=True)
+
+        self.assertEqual(list(map(len, trajectories)),
+                         list(map(len, array_trajectories)))
+        for trajectory, array_trajectory in zip(trajectories, array_trajectories):
+            self.assertEqual([step[-2] for step in trajectory],
+                             array_trajectory[:, 4].tolist())
+
 
 if __name__ == '__main__':
     unittest.main()
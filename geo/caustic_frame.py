@@ -1,3 +1,5 @@
+from copy import copy
+
 import numpy as np
 import matplotlib.pyplot as plt
 import ezdxf
@@ -5,6 +7,7 @@ from ezdxf.groupby import groupby
 from shapely.geometry import Polygon
 from shapely.geometry import LineString
 from shapely.geometry.polygon import orient
+from shapely.prepared import prep
 
 
 class Frame:
@@ -82,32 +85,68 @@ class Frame:
                     self.body = self.body.union(inter)
 
         self.body = orient(self.body, -1)  # order clockwise
-        xs, ys = self.body.exterior.coords.xy
-        layers = [0] * (len(xs) - 1)
+        coords = list(self.body.exterior.coords)
+        segments = list(zip(coords[:-1], coords[1:]))
+        layers = [0] * len(segments)
 
         for layer in self.ps.keys():
             if layer == '0':
                 continue
             for poly in self.ps[layer]:
-                ohm = Polygon(poly)
-                for i, (x, y) in enumerate(zip(xs[:-1], ys[:-1])):
-                    if ohm.contains(LineString([(x, y), (xs[i+1], ys[i+1])])):
+                # Prepared, as every segment of the outline is tested against each contact
+                ohm = prep(Polygon(poly))
+                for i, segment in enumerate(segments):
+                    if ohm.contains(LineString(segment)):
                         layers[i] = int(layer)
 
         self.edges = []
-        for i, (x, y) in enumerate(zip(xs[:-1], ys[:-1])):
-            self.edges.append(Edge(x, y, xs[i+1], ys[i+1], layers[i]))
+        for ((x0, y0), (x1, y1)), layer in zip(segments, layers):
+            self.edges.append(Edge(x0, y0, x1, y1, layer))
 
     def _gen_matrices_for_det(self):
         '''
         Generates a few matricies that will be used in calculating intersections with edges
         '''
-        self.px0 = np.array([edge.xs[0] for edge in self.edges])
-        self.px1 = np.array([edge.xs[1] for edge in self.edges])
-        self.py0 = np.array([edge.ys[0] for edge in self.edges])
-        self.py1 = np.array([edge.ys[1] for edge in self.edges])
+        self.px0 = np.array([edge.xs[0] for edge in self.edges], dtype=np.float64)
+        self.px1 = np.array([edge.xs[1] for edge in self.edges], dtype=np.float64)
+        self.py0 = np.array([edge.ys[0] for edge in self.edges], dtype=np.float64)
+        self.py1 = np.array([edge.ys[1] for edge in self.edges], dtype=np.float64)
         self.x23 = self.px0 - self.px1
         self.y23 = self.py0 - self.py1
+        self.dx = self.px1 - self.px0
+        self.dy = self.py1 - self.py0
+        self.xmin = np.minimum(self.px0, self.px1)
+        self.xmax = np.maximum(self.px0, self.px1)
+        self.ymin = np.minimum(self.py0, self.py1)
+        self.ymax = np.maximum(self.py0, self.py1)
+        self.nx = np.array([edge.normal[0] for edge in self.edges], dtype=np.float64)
+        self.ny = np.array([edge.normal[1] for edge in self.edges], dtype=np.float64)
+
+    def contains_point(self, x, y):
+        '''
+        Returns True if (x, y) lies inside or on the boundary of the body, like body.intersects
+        Uses a ray cast along +x against the edges, with the side of each edge taken from the
+        sign of a cross product so that horizontal edges need no division
+        '''
+        cross = (x - self.px0)*self.dy - (y - self.py0)*self.dx
+        on_edge = (cross == 0) & (self.xmin <= x) & (x <= self.xmax) & \
+            (self.ymin <= y) & (y <= self.ymax)
+        if on_edge.any():
+            return True
+
+        # The ray crosses an edge straddling y if the point lies left of it
+        straddles = (self.py0 > y) != (self.py1 > y)
+        crosses = straddles & ((cross < 0) == (self.dy > 0))
+        return np.count_nonzero(crosses) % 2 == 1
+
+    def clone_shallow(self):
+        '''
+        Returns a copy of the frame with its own Edge objects that shares the geometry and
+        intersection arrays with this frame
+        '''
+        frame = copy(self)
+        frame.edges = [copy(edge) for edge in self.edges]
+        return frame
 
     def gen_fig(self):
         '''
@@ -123,9 +162,10 @@ class Frame:
 
         return fig
 
-    def get_inject_position(self, layer, bias=True):
+    def get_inject_position(self, layer, bias=True, rand=np.random.rand):
         '''
         Randomly pick a position along the perimeter of a given ohmic edge
+        rand is called without arguments for uniform random numbers in [0, 1)
         '''
         edges_in_layer = []
         for edge in self.edges:
@@ -137,7 +177,7 @@ class Frame:
 
         r = 0  # We are forcing r in (0, 1), to not return a corner
         while r == 0:
-            r = np.random.rand()
+            r = rand()
 
         lengths = [edge.length for edge in edges_in_layer]
         edge_prob = np.cumsum(lengths)/np.sum(lengths)
@@ -191,6 +231,7 @@ class Edge:
         self.normal = np.array(
             [np.cos(self.normal_angle), np.sin(self.normal_angle)])
         self.linestring = LineString([(x0, y0), (x1, y1)])
+        self.index = -1
 
     def __repr__(self):
         return '(({0}, {1}), ({2}, {3}), {4})'.format(self.start[0], self.start[1], self.end[0], self.end[1], self.layer)
@@ -207,17 +248,30 @@ class Edge:
         self.in_prob = in_prob
         self.cum_prob = cum_prob
 
-    def get_injection_index(self):
-        return Edge.compute_injection_index(self.cum_prob)
+    def set_index(self, index):
+        '''
+        Sets the position of the edge in the count arrays of a simulation
+        '''
+        self.index = index
+
+    def get_injection_index(self, r=None):
+        return Edge.compute_injection_index(self.cum_prob, r)
 
     @staticmethod
-    def compute_injection_index(cum_prob):
+    def compute_injection_index(cum_prob, r=None):
         '''
         Returns an index n which is allowable to inject into and a fractional scaling factor
+        r is a uniform random number in [0, 1), drawn from np.random if not given
         '''
-        r = np.random.rand()
-        n = np.argmax(cum_prob > r)
-        if n == 0:
+        if r is None:
+            r = np.random.rand()
+        n = int(np.searchsorted(cum_prob, r, side='right'))
+        if n == len(cum_prob):
+            # Rounding left cum_prob[-1] <= r, take the last state with a nonzero probability
+            # rather than the trailing zero probability ones, at the end of its range
+            n = int(np.searchsorted(cum_prob, cum_prob[-1], side='left'))
+            f = 0.0
+        elif n == 0:
             f = 1 - (r) / (cum_prob[n])
         else:
             f = 1 - (r - cum_prob[n-1])/(cum_prob[n] - cum_prob[n-1])
@@ -238,6 +292,15 @@ class OhmicLines:
         self._gen_edges()
         self._gen_matrices_for_det()
 
+    def clone_shallow(self):
+        '''
+        Returns a copy of the ohmic lines with their own Edge objects that shares the
+        intersection arrays with these lines
+        '''
+        ohmic_lines = copy(self)
+        ohmic_lines.lines_as_edges = [copy(edge) for edge in self.lines_as_edges]
+        return ohmic_lines
+
     def _gen_edges(self):
         '''
         Takes the lines and generates edges of those lines
@@ -251,9 +314,17 @@ class OhmicLines:
         '''
         Generates a few matricies that will be used in calculating intersections with the ohmic lines
         '''
-        self.px0 = np.array([edge.xs[0] for edge in self.lines_as_edges])
-        self.px1 = np.array([edge.xs[1] for edge in self.lines_as_edges])
-        self.py0 = np.array([edge.ys[0] for edge in self.lines_as_edges])
-        self.py1 = np.array([edge.ys[1] for edge in self.lines_as_edges])
+        self.px0 = np.array([edge.xs[0] for edge in self.lines_as_edges], dtype=np.float64)
+        self.px1 = np.array([edge.xs[1] for edge in self.lines_as_edges], dtype=np.float64)
+        self.py0 = np.array([edge.ys[0] for edge in self.lines_as_edges], dtype=np.float64)
+        self.py1 = np.array([edge.ys[1] for edge in self.lines_as_edges], dtype=np.float64)
         self.x23 = self.px0 - self.px1
         self.y23 = self.py0 - self.py1
+        self.dx = self.px1 - self.px0
+        self.dy = self.py1 - self.py0
+        self.xmin = np.minimum(self.px0, self.px1)
+        self.xmax = np.maximum(self.px0, self.px1)
+        self.ymin = np.minimum(self.py0, self.py1)
+        self.ymax = np.maximum(self.py0, self.py1)
+        self.nx = np.array([edge.normal[0] for edge in self.lines_as_edges], dtype=np.float64)
+        self.ny = np.array([edge.normal[1] for edge in self.lines_as_edges], dtype=np.float64)
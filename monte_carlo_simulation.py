@@ -1,16 +1,44 @@
-from math import isnan
+from math import isnan, hypot
 import time
 import pickle
+import os
 import os.path
+from multiprocessing import Pool
 
 import numpy as np
-from shapely.geometry import Point
 from enum import IntEnum
-from copy import deepcopy
 
 from ballistic_montecarlo.geo.caustic_frame import Edge, OhmicLines
 from ballistic_montecarlo.bandstructure.caustic_bandstructure import Bandstructure
 
+try:
+    from numba import njit
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+try:
+    from shapely import STRtree, box  # shapely >= 2.0
+except ImportError:
+    STRtree = None
+
+# Number of uniform random numbers drawn at once for the per-step decisions
+RAND_BUFFER_SIZE = 1 << 16
+
+# Maximum number of steps the compiled free flight loop takes before returning to Python
+FREE_FLIGHT_STEPS = 4096
+
+# Number of chunks per worker in run_simulation_parallel, so that long trajectories
+# do not leave the other workers idle
+CHUNKS_PER_WORKER = 4
+
+# Frames with at least this many edges get a spatial index to prune the intersection search
+STRTREE_MIN_EDGES = 64
+
+# Below the STR tree size, the NumPy intersection search first drops segments whose bounding
+# box misses that of the step once there are at least this many
+AABB_MIN_EDGES = 16
+
 
 def calc_ohmstats(fields, results):
     ohmstats = {}
@@ -26,6 +54,112 @@ def calc_ohmstats(fields, results):
     return ohmstats
 
 
+def _edge_hits_kernel(x, y, x_del, y_del, px0, py0, x23, y23, nx, ny, oriented):
+    '''
+    Scans all segments for crossings by the step (x, y) -> (x + x_del, y + y_del)
+    Returns the indices of the crossed segments and the fractional position u along each
+    If oriented, only segments crossed against their normal are returned
+    '''
+    n = px0.shape[0]
+    idx = np.empty(n, dtype=np.int64)
+    us = np.empty(n, dtype=np.float64)
+    x01 = -x_del
+    y01 = -y_del
+    count = 0
+    for i in range(n):
+        if oriented and not x_del*nx[i] + y_del*ny[i] < 0:
+            continue
+        denominator = x01*y23[i] - y01*x23[i]
+        if denominator == 0:
+            continue
+        x02 = x - px0[i]
+        y02 = y - py0[i]
+        t = (x02*y23[i] - y02*x23[i]) / denominator
+        u = -(x01*y02 - y01*x02) / denominator
+        if 0 <= t and t <= 1 and 0 <= u and u <= 1:
+            idx[count] = i
+            us[count] = u
+            count += 1
+    return idx[:count], us[:count]
+
+
+def _step_hits_edge(x, y, x_del, y_del, px0, py0, x23, y23, dx, dy, nx, ny):
+    '''
+    Returns True if the step (x, y) -> (x + x_del, y + y_del) intersects an edge against its
+    normal anywhere but at its starting point, matching _get_intersection_arrays
+    '''
+    x01 = -x_del
+    y01 = -y_del
+    for i in range(px0.shape[0]):
+        if not x_del*nx[i] + y_del*ny[i] < 0:
+            continue
+        denominator = x01*y23[i] - y01*x23[i]
+        if denominator == 0:
+            continue
+        x02 = x - px0[i]
+        y02 = y - py0[i]
+        t = (x02*y23[i] - y02*x23[i]) / denominator
+        u = -(x01*y02 - y01*x02) / denominator
+        if 0 <= t and t <= 1 and 0 <= u and u <= 1:
+            if px0[i] + u*dx[i] != x or py0[i] + u*dy[i] != y:
+                return True
+    return False
+
+
+def _count_crossings(x, y, x_del, y_del, px0, py0, x23, y23, counts):
+    '''
+    Adds one to counts for every segment crossed by the step (x, y) -> (x + x_del, y + y_del)
+    '''
+    x01 = -x_del
+    y01 = -y_del
+    for i in range(px0.shape[0]):
+        denominator = x01*y23[i] - y01*x23[i]
+        if denominator == 0:
+            continue
+        x02 = x - px0[i]
+        y02 = y - py0[i]
+        t = (x02*y23[i] - y02*x23[i]) / denominator
+        u = -(x01*y02 - y01*x02) / denominator
+        if 0 <= t and t <= 1 and 0 <= u and u <= 1:
+            counts[i] += 1
+
+
+def _free_flight_kernel(idx, frac, x, y, dr_x, dr_y, px0, py0, x23, y23, dx, dy, nx, ny,
+                        lines_px0, lines_py0, lines_x23, lines_y23, line_counts, out):
+    '''
+    Propagates a carrier in state (idx, frac) from (x, y) for as long as its steps do not
+    hit an edge, counting ohmic line crossings into line_counts
+    Each step is written to a row of out as (state index, x, y). Stops before the first
+    step that hits an edge or once out is full and returns the number of steps taken
+    '''
+    n_k = dr_x.shape[0]
+    for count in range(out.shape[0]):
+        x_new = x + frac*dr_x[idx]
+        y_new = y + frac*dr_y[idx]
+        x_del = x_new - x
+        y_del = y_new - y
+        if _step_hits_edge(x, y, x_del, y_del, px0, py0, x23, y23, dx, dy, nx, ny):
+            return count
+
+        _count_crossings(x, y, x_del, y_del, lines_px0, lines_py0,
+                         lines_x23, lines_y23, line_counts)
+        idx = (idx + 1) % n_k
+        frac = 1.0
+        x = x_new
+        y = y_new
+        out[count, 0] = idx
+        out[count, 1] = x
+        out[count, 2] = y
+    return out.shape[0]
+
+
+if HAS_NUMBA:
+    _edge_hits_kernel = njit(cache=True)(_edge_hits_kernel)
+    _step_hits_edge = njit(cache=True)(_step_hits_edge)
+    _count_crossings = njit(cache=True)(_count_crossings)
+    _free_flight_kernel = njit(cache=True)(_free_flight_kernel)
+
+
 class TrajectoryState(IntEnum):
     '''
     Used for specifying the state of a step returned by Simulation._step_positionS
@@ -46,6 +180,101 @@ class TrajectoryState(IntEnum):
 ALL_STATES = set(range(11))
 
 
+class TrajectoryBuffer:
+    '''
+    Ragged storage for trajectories, used by run_simulation with trajectory_arrays=True
+    Every step is a row (state index, state fraction, x, y, TrajectoryState, edge index) of a
+    single growable float64 array, with an edge index of -1 for steps without an edge.
+    Trajectories are consecutive runs of rows, delimited by starts
+    '''
+
+    def __init__(self, capacity=1 << 12):
+        self.rows = np.empty((capacity, 6))
+        self.n_rows = 0
+        self.starts = [0]
+
+    def _reserve(self, n_new):
+        if self.n_rows + n_new > len(self.rows):
+            rows = np.empty((max(2*len(self.rows), self.n_rows + n_new), 6))
+            rows[:self.n_rows] = self.rows[:self.n_rows]
+            self.rows = rows
+
+    def add_steps(self, steps):
+        '''
+        Appends steps in the (n_f, x, y, state, edge) form returned by Simulation._step_position
+        '''
+        self._reserve(len(steps))
+        rows = self.rows
+        for (idx, frac), x, y, state, edge in steps:
+            rows[self.n_rows] = (idx, frac, x, y, state,
+                                 -1 if edge is None else edge.index)
+            self.n_rows += 1
+
+    def add_propagation(self, steps):
+        '''
+        Appends the (state index, x, y) rows written by the free flight loop as PROPAGATE steps
+        '''
+        n_new = len(steps)
+        self._reserve(n_new)
+        rows = self.rows[self.n_rows:self.n_rows + n_new]
+        rows[:, 0] = steps[:, 0]
+        rows[:, 1] = 1
+        rows[:, 2:4] = steps[:, 1:]
+        rows[:, 4] = TrajectoryState.PROPAGATE
+        rows[:, 5] = -1
+        self.n_rows += n_new
+
+    def end_trajectory(self):
+        self.starts.append(self.n_rows)
+
+    def trajectories(self):
+        '''
+        Returns the trajectories as a list of (n_steps, 6) views into a single array
+        '''
+        rows = self.rows[:self.n_rows]
+        return [rows[start:end] for start, end in zip(self.starts[:-1], self.starts[1:])]
+
+
+class InterleavedTrajectoryBuffer(TrajectoryBuffer):
+    '''
+    TrajectoryBuffer for carriers that take turns stepping, as in run_simulation_batched
+    Every row also records the index of its trajectory, which trajectories() groups by
+    '''
+
+    def __init__(self, n_trajectories, capacity=1 << 12):
+        super().__init__(capacity)
+        self.n_trajectories = n_trajectories
+        self.owners = np.empty(capacity, dtype=np.int64)
+
+    def _reserve(self, n_new):
+        super()._reserve(n_new)
+        if len(self.owners) < len(self.rows):
+            owners = np.empty(len(self.rows), dtype=np.int64)
+            owners[:self.n_rows] = self.owners[:self.n_rows]
+            self.owners = owners
+
+    def add_steps(self, steps, owner):
+        start = self.n_rows
+        super().add_steps(steps)
+        self.owners[start:self.n_rows] = owner
+
+    def add_propagation(self, steps, owners):
+        start = self.n_rows
+        super().add_propagation(steps)
+        self.owners[start:self.n_rows] = owners
+
+    def trajectories(self):
+        '''
+        Returns the trajectories as a list of (n_steps, 6) arrays, with the steps of each in the
+        order they were added. They are slices of a regrouped copy of the rows, so writing to
+        them does not change the buffer
+        '''
+        owners = self.owners[:self.n_rows]
+        rows = self.rows[np.argsort(owners, kind='stable')]
+        ends = np.cumsum(np.bincount(owners, minlength=self.n_trajectories))
+        return np.split(rows, ends[:-1])
+
+
 class Simulation:
     def __init__(self, frame, k, phi, field, p_scatter=1.0, p_ohmic_absorb=1.0, ohmic_lines=OhmicLines([])):
         '''
@@ -57,17 +286,30 @@ class Simulation:
             p_scatter: probability of scattering from an edge (instead of reflecting)
             p_ohmic_absorb: probability of an ohmic absorbing an impinging charge
         '''
-        self._frame = deepcopy(frame)
-        self._ohmic_lines = deepcopy(ohmic_lines)
+        # Edges carry per-simulation state (injection probabilities, indices and the ohmic
+        # line layers), so each simulation gets its own edges on top of the shared geometry
+        self._frame = frame.clone_shallow()
+        self._ohmic_lines = ohmic_lines.clone_shallow()
         self._bandstructure = Bandstructure(k, phi, field)
+        # Row per state so that a lookup reads two neighbouring scalars
+        self._r_T = np.ascontiguousarray(
+            np.transpose(self._bandstructure.r), dtype=np.float64)
+        # Steps along the Fermi surface, split by component into flat arrays
+        self._dr_x = np.ascontiguousarray(
+            self._bandstructure.dr[0], dtype=np.float64)
+        self._dr_y = np.ascontiguousarray(
+            self._bandstructure.dr[1], dtype=np.float64)
+        self._nk = self._bandstructure.dr.shape[1]
         self._p_scatter = p_scatter
         self._p_ohmic_absorb = p_ohmic_absorb
+        self._rand_buf = []
+        self._rand_idx = 0
 
         # Calculate injection probabilities for each edge.
+        in_probs, cum_probs = self._bandstructure.calculate_injection_prob_batch(
+            [edge.normal_angle for edge in self._frame.edges])
         max_layer = 0
-        for edge in self._frame.edges:
-            in_prob, cum_prob = self._bandstructure.calculate_injection_prob(
-                edge.normal_angle)
+        for edge, in_prob, cum_prob in zip(self._frame.edges, in_probs, cum_probs):
             edge.set_in_prob(in_prob, cum_prob)
             if edge.layer > max_layer:
                 max_layer = edge.layer
@@ -75,9 +317,66 @@ class Simulation:
         for line in self._ohmic_lines.lines_as_edges:
             line.layer += max_layer + 1
 
+        self._frame_tree = self._build_tree(self._frame.edges)
+        self._ohmic_lines_tree = self._build_tree(
+            self._ohmic_lines.lines_as_edges)
+
+        # Frame edges followed by ohmic lines, giving the order of the count arrays
+        self._edges = self._frame.edges + self._ohmic_lines.lines_as_edges
+        for i, edge in enumerate(self._edges):
+            edge.set_index(i)
+        # Convolved injection cumulative probabilities, keyed by corner edge index pair
+        self._corner_cum_probs = {}
+        # Random numbers come from the global np.random state unless a seed is set
+        self._rng = None
+
+    def set_seed(self, seed):
+        '''
+        Draws the random numbers of this simulation from its own np.random.Generator seeded with
+        seed (anything np.random.default_rng accepts), instead of the global np.random state
+        '''
+        self._rng = np.random.default_rng(seed)
+        self._reset_rand()
+
+    def _rand(self):
+        '''
+        Returns a uniform random number in [0, 1) from a buffer drawn in bulk, see set_seed
+        '''
+        if self._rand_idx >= len(self._rand_buf):
+            if self._rng is None:
+                self._rand_buf = np.random.rand(RAND_BUFFER_SIZE).tolist()
+            else:
+                self._rand_buf = self._rng.random(RAND_BUFFER_SIZE).tolist()
+            self._rand_idx = 0
+        r = self._rand_buf[self._rand_idx]
+        self._rand_idx += 1
+        return r
+
+    def _reset_rand(self):
+        '''
+        Discards any buffered random numbers so that the next draw follows the current random state
+        '''
+        self._rand_buf = []
+        self._rand_idx = 0
+
+    def _counts_to_dict(self, counts):
+        '''
+        Converts an array of counts indexed like self._edges into the edge_to_count dictionary
+        '''
+        return {edge: int(count) for edge, count in zip(self._edges, counts)}
+
+    @staticmethod
+    def _build_tree(edges):
+        '''
+        Builds an STR tree over the edges if there are enough of them to make it worthwhile
+        '''
+        if STRtree is None or len(edges) < STRTREE_MIN_EDGES:
+            return None
+        return STRtree([edge.linestring for edge in edges])
+
     def run_simulation_with_cache(self, identifier, n_inject, path='data/', stored_states=ALL_STATES, debug=False):
         full_path = path+identifier+'.pkl'
-        if os.path.isfile(path):
+        if os.path.isfile(full_path):
             print('path {} already exists, loading data'.format(full_path))
             with open(full_path, 'rb') as f:
                 edge_to_count, trajectories = pickle.load(f)
@@ -85,243 +384,416 @@ class Simulation:
 
         print('path {} does not exist, running simulation'.format(full_path))
         edge_to_count, trajectories = self.run_simulation(
-            n_inject, stored_states=stored_states, debug=False)
+            n_inject, stored_states=stored_states, debug=debug)
+        if path:
+            os.makedirs(path, exist_ok=True)
         with open(full_path, 'wb') as f:
-            pickle.dump((edge_to_count, trajectories), f)
+            pickle.dump((edge_to_count, trajectories), f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
 
         return edge_to_count, trajectories
 
-    def run_simulation(self, n_inject, stored_states=ALL_STATES, debug=False):
+    def run_simulation(self, n_inject, stored_states=ALL_STATES, debug=False, n_workers=1, trajectory_arrays=False):
         '''
         Propagates n_inject charge carriers until they are absorbed by a grounded contact
+        If n_workers > 1 the carriers are split over that many processes, see run_simulation_parallel
+        If trajectory_arrays is set, each trajectory is returned as an array of steps instead of
+        a list of tuples, see TrajectoryBuffer
         '''
+        if n_workers > 1:
+            return self.run_simulation_parallel(n_inject, n_workers, stored_states=stored_states, debug=debug,
+                                                trajectory_arrays=trajectory_arrays)
+
+        counts, trajectories = self._run(
+            n_inject, stored_states, debug, trajectory_arrays)
+        return self._counts_to_dict(counts), trajectories
 
+    def _run(self, n_inject, stored_states=ALL_STATES, debug=False, trajectory_arrays=False):
+        '''
+        Serial propagation loop of run_simulation
+        Returns the counts as an array indexed like self._edges
+        '''
+        self._reset_rand()
         trajectories = []
-        edge_to_count = {}
-        for edge in self._frame.edges:
-            edge_to_count[edge] = 0
+        buffer = TrajectoryBuffer() if trajectory_arrays else None
+        counts = np.zeros(len(self._edges), dtype=np.int64)
 
-        for line in self._ohmic_lines.lines_as_edges:
-            edge_to_count[line] = 0
+        # Only if every state is kept the trajectory needs no filtering. ALL_STATES leaves out
+        # ERROR, so the default still filters
+        store_all = set(TrajectoryState).issubset(stored_states)
+        stored_states = frozenset(stored_states)
+        store_propagate = TrajectoryState.PROPAGATE in stored_states
+
+        # Without numba the compiled free flight loop would run as slow Python, and in debug
+        # mode every step has to be checked individually
+        use_free_flight = HAS_NUMBA and not debug
+        free_flight = np.empty((FREE_FLIGHT_STEPS, 3))
+        line_counts = counts[len(self._frame.edges):]
 
         for _ in range(n_inject):
             trajectory = []
             state = TrajectoryState.INJECTING
-            (x, y), injecting_edge = self._frame.get_inject_position(1)
-            n_f = injecting_edge.get_injection_index()
+            (x, y), injecting_edge = self._frame.get_inject_position(
+                1, rand=self._rand)
+            n_f = injecting_edge.get_injection_index(self._rand())
 
             step_params = [(n_f, x, y, state, injecting_edge)]
 
-            # Optimize to either or not based on full or empty filter
-            trajectory.extend(
-                filter(lambda step: step[-2] in stored_states, step_params))
+            if store_all or state in stored_states:
+                if buffer is None:
+                    trajectory.extend(step_params)
+                else:
+                    buffer.add_steps(step_params)
 
             while state != TrajectoryState.ABSORBED:
                 n_f = step_params[-1][0]
                 x = step_params[-1][1]
                 y = step_params[-1][2]
+
+                if use_free_flight:
+                    n_free = self._free_flight(
+                        n_f, x, y, line_counts, free_flight)
+                    if n_free:
+                        if store_propagate:
+                            if buffer is None:
+                                trajectory.extend([((int(n), 1), x_p, y_p, TrajectoryState.PROPAGATE, None)
+                                                   for n, x_p, y_p in free_flight[:n_free].tolist()])
+                            else:
+                                buffer.add_propagation(free_flight[:n_free])
+                        n, x, y = free_flight[n_free - 1].tolist()
+                        n_f = (int(n), 1)
+
                 step_params, line_crosses = self._step_position(
                     n_f, x, y, debug)
 
                 state = step_params[-1][-2]
 
-                trajectory.extend(
-                    filter(lambda step: step[-2] in stored_states, step_params))
+                if store_all:
+                    stored = step_params
+                else:
+                    stored = [step for step in step_params if step[-2] in stored_states]
+                if buffer is None:
+                    trajectory.extend(stored)
+                else:
+                    buffer.add_steps(stored)
 
                 for step_param in step_params:
                     edge = step_param[-1]
-                    if edge in edge_to_count:
-                        edge_to_count[edge] += 1
+                    if edge is not None:
+                        counts[edge.index] += 1
 
                 for line in line_crosses:
-                    edge_to_count[line] += 1
+                    counts[line.index] += 1
 
-            trajectories.append(trajectory)
+            if buffer is None:
+                trajectories.append(trajectory)
+            else:
+                buffer.end_trajectory()
 
-        return edge_to_count, trajectories
+        if buffer is not None:
+            trajectories = buffer.trajectories()
+        return counts, trajectories
+
+    def run_simulation_parallel(self, n_inject, n_workers=None, seed=None, stored_states=ALL_STATES, debug=False,
+                                trajectory_arrays=False):
+        '''
+        Splits n_inject charge carriers over n_workers processes and merges the results
+        The carriers are handed out in CHUNKS_PER_WORKER chunks per worker to balance the
+        load. Every chunk draws from an independent random stream spawned from seed, so the
+        result is reproducible for a given seed and n_workers
+        '''
+        if n_workers is None:
+            n_workers = os.cpu_count()
+
+        n_chunks = max(1, min(n_inject, n_workers*CHUNKS_PER_WORKER))
+        seeds = np.random.SeedSequence(seed).spawn(n_chunks)
+        chunks = [(n_inject // n_chunks + (i < n_inject % n_chunks), chunk_seed, stored_states, debug,
+                   trajectory_arrays) for i, chunk_seed in enumerate(seeds)]
+
+        with Pool(n_workers) as pool:
+            results = pool.map(self._run_chunk, chunks, chunksize=1)
+
+        # Workers operate on copies of the edges, so map their indices back onto ours
+        counts = np.zeros(len(self._edges), dtype=np.int64)
+        trajectories = []
+        for chunk_counts, chunk_trajectories in results:
+            counts += chunk_counts
+            if trajectory_arrays:
+                trajectories.extend(chunk_trajectories)
+                continue
+            for trajectory in chunk_trajectories:
+                trajectories.append([step[:-1] + (None if step[-1] is None else self._edges[step[-1]],)
+                                     for step in trajectory])
+
+        return self._counts_to_dict(counts), trajectories
+
+    def _run_chunk(self, args):
+        '''
+        Runs a share of run_simulation_parallel inside a worker process
+        Returns the edges in the trajectories as indices into self._edges
+        '''
+        n_inject, seed, stored_states, debug, trajectory_arrays = args
+        self.set_seed(seed)
+        counts, trajectories = self._run(
+            n_inject, stored_states, debug, trajectory_arrays)
+        if trajectory_arrays:
+            return counts, trajectories
+
+        trajectories = [[step[:-1] + (None if step[-1] is None else step[-1].index,)
+                         for step in trajectory] for trajectory in trajectories]
+        return counts, trajectories
+
+    def run_simulation_batched(self, n_inject, n_batch=64, stored_states=ALL_STATES, debug=False,
+                               trajectory_arrays=False):
+        '''
+        Propagates n_inject charge carriers like run_simulation, but steps up to n_batch of
+        them in lockstep. Carriers whose next step cannot hit an edge are advanced together
+        with array operations; only carriers reaching an edge go through _step_position, or
+        every carrier in debug mode. When a carrier is absorbed, the next pending injection
+        takes over its slot.
+        '''
+        self._reset_rand()
+        if trajectory_arrays:
+            buffer = InterleavedTrajectoryBuffer(n_inject)
+        else:
+            buffer = None
+            trajectories = [[] for _ in range(n_inject)]
+        counts = np.zeros(len(self._edges), dtype=np.int64)
+        line_counts = counts[len(self._frame.edges):]
+
+        dr_x = self._dr_x
+        dr_y = self._dr_y
+        n_k = self._nk
+        store_all = set(TrajectoryState).issubset(stored_states)
+        stored_states = frozenset(stored_states)
+        store_propagate = TrajectoryState.PROPAGATE in stored_states
+
+        # Structure of arrays holding the state of every slot in the batch
+        n_batch = min(n_batch, n_inject)
+        particle = np.zeros(n_batch, dtype=np.int64)
+        n_f_idx = np.zeros(n_batch, dtype=np.int64)
+        n_f_frac = np.zeros(n_batch)
+        x = np.zeros(n_batch)
+        y = np.zeros(n_batch)
+        alive = np.zeros(n_batch, dtype=bool)
+        queue_ptr = 0
+
+        while queue_ptr < n_inject or alive.any():
+            # Swap fresh injections into empty slots
+            for slot in np.flatnonzero(~alive):
+                if queue_ptr == n_inject:
+                    break
+                (x_inject, y_inject), injecting_edge = self._frame.get_inject_position(
+                    1, rand=self._rand)
+                n_f = injecting_edge.get_injection_index(self._rand())
+                if TrajectoryState.INJECTING in stored_states:
+                    step = (n_f, x_inject, y_inject, TrajectoryState.INJECTING, injecting_edge)
+                    if buffer is None:
+                        trajectories[queue_ptr].append(step)
+                    else:
+                        buffer.add_steps([step], queue_ptr)
+
+                particle[slot] = queue_ptr
+                n_f_idx[slot], n_f_frac[slot] = n_f
+                x[slot] = x_inject
+                y[slot] = y_inject
+                alive[slot] = True
+                queue_ptr += 1
+
+            active = np.flatnonzero(alive)
+            idx = n_f_idx[active]
+            x_old = x[active]
+            y_old = y[active]
+            x_new = x_old + n_f_frac[active]*dr_x[idx]
+            y_new = y_old + n_f_frac[active]*dr_y[idx]
+            x_del = x_new - x_old
+            y_del = y_new - y_old
+
+            if debug:
+                # Every step goes through _step_position and its bounds check, as in _run
+                hit = np.ones(len(active), dtype=bool)
+            else:
+                hit = self._get_batch_hits(
+                    x_old, y_old, x_del, y_del, self._frame, True).any(axis=1)
+
+            # Carriers in free flight propagate without touching an edge
+            free = ~hit
+            slots = active[free]
+            n_f_idx[slots] = (idx[free] + 1) % n_k
+            n_f_frac[slots] = 1
+            x[slots] = x_new[free]
+            y[slots] = y_new[free]
+
+            if len(line_counts):
+                line_counts += self._get_batch_hits(
+                    x_old[free], y_old[free], x_del[free], y_del[free], self._ohmic_lines, False).sum(axis=0)
+
+            if store_propagate and buffer is not None:
+                buffer.add_propagation(np.column_stack(
+                    (n_f_idx[slots], x[slots], y[slots])), particle[slots])
+            elif store_propagate:
+                for p, n, x_p, y_p in zip(particle[slots].tolist(), n_f_idx[slots].tolist(),
+                                          x[slots].tolist(), y[slots].tolist()):
+                    trajectories[p].append(
+                        ((n, 1), x_p, y_p, TrajectoryState.PROPAGATE, None))
+
+            # Carriers at an edge are resolved one at a time
+            for slot in active[hit]:
+                step_params, line_crosses = self._step_position(
+                    (n_f_idx[slot], n_f_frac[slot]), x[slot], y[slot], debug)
+
+                if store_all:
+                    stored = step_params
+                else:
+                    stored = [step for step in step_params if step[-2] in stored_states]
+                if buffer is None:
+                    trajectories[particle[slot]].extend(stored)
+                else:
+                    buffer.add_steps(stored, particle[slot])
+
+                for step_param in step_params:
+                    edge = step_param[-1]
+                    if edge is not None:
+                        counts[edge.index] += 1
+
+                for line in line_crosses:
+                    counts[line.index] += 1
+
+                n_f, x_step, y_step, state, _ = step_params[-1]
+                if state == TrajectoryState.ABSORBED:
+                    alive[slot] = False
+                else:
+                    n_f_idx[slot], n_f_frac[slot] = n_f
+                    x[slot] = x_step
+                    y[slot] = y_step
+
+        if buffer is not None:
+            trajectories = buffer.trajectories()
+        return self._counts_to_dict(counts), trajectories
+
+    def _free_flight(self, n_f, x, y, line_counts, out):
+        '''
+        Takes the steps from (x, y) up to the next edge hit in compiled code, see _free_flight_kernel
+        '''
+        frame = self._frame
+        lines = self._ohmic_lines
+        return _free_flight_kernel(n_f[0], float(n_f[1]), x, y, self._dr_x, self._dr_y,
+                                   frame.px0, frame.py0, frame.x23, frame.y23, frame.dx, frame.dy, frame.nx, frame.ny,
+                                   lines.px0, lines.py0, lines.x23, lines.y23, line_counts, out)
 
     def _step_position(self, n_f, x, y, debug=False):
         step_params = []
-        if debug and not self._frame.body.intersects(Point(x, y)):
+        if debug and not self._frame.contains_point(x, y):
             print('Previous step stepped out of bounds')
             print(n_f, x, y)
             return [(n_f, x, y, TrajectoryState.ERROR, None)]
 
         n_f_new, x_new, y_new = self._update_position(n_f, x, y)
+        x_del = x_new - x
+        y_del = y_new - y
 
-        step_coords = ([(x, y), (x_new, y_new)])
-
-        intersections = self._get_sorted_intersections(step_coords)
-        line_crosses = self._get_crosses(step_coords)
+        intersections = self._get_sorted_intersections(x, y, x_del, y_del)
+        line_crosses = self._get_crosses(x, y, x_del, y_del)
 
-        # TODO: This big ole block is convoluted and has lots of repetition.
-        #       Consider refactoring, or at least naming things more clearly.
         if len(intersections) == 0:
             step_params.append(
                 (n_f_new, x_new, y_new, TrajectoryState.PROPAGATE, None))
-
-        elif len(intersections) == 1 or intersections[0][3] != intersections[1][3]:
-            # Single edge intersection
-            edge, x_int, y_int, _ = intersections[0]
-            n_f_int = self._get_n_f_intersection(
-                n_f, [(x, y), (x_int, y_int), (x_new, y_new)])
-
-            if edge.layer == 0:
-                # Device edge
+            return step_params, line_crosses
+
+        corner = len(intersections) > 1 and intersections[0][3] == intersections[1][3]
+        edge_0, x_int, y_int, _ = intersections[0]
+        if corner:
+            edge_1 = intersections[1][0]
+            # to avoid double counting
+            edge = edge_1 if edge_1.layer > edge_0.layer else edge_0
+            # NOTE: preserved quirk of the original corner handling, not a deliberate rule.
+            # Corners compare against layer 1 (the injector) instead of 0, so an injector
+            # corner collides like a device edge while a corner between two device edges
+            # takes the absorb path and is reinjected from layer 0
+            device_layer = 1
+        else:
+            edge = edge_0
+            device_layer = 0
+        layer = edge.layer
+
+        n_f_int = self._get_n_f_intersection(
+            n_f, [(x, y), (x_int, y_int), (x_new, y_new)])
+
+        if layer != device_layer and self._rand() < self._p_ohmic_absorb:
+            absorbed = TrajectoryState.CABSORBED if corner and layer != 2 else TrajectoryState.ABSORBED
+            step_params.append((n_f_int, x_int, y_int, absorbed, edge))
+
+            if layer != 2:
+                # Floating ohmic, reemit
+                (x_new, y_new), reinjecting_edge = self._frame.get_inject_position(
+                    layer, rand=self._rand)
+                n_f_new = reinjecting_edge.get_injection_index(self._rand())
                 step_params.append(
-                    (n_f_int, x_int, y_int, TrajectoryState.COLLISION, edge))
+                    (n_f_new, x_new, y_new, TrajectoryState.INJECTING, None))
+            return step_params, line_crosses
 
-                if np.random.rand() < self._p_scatter:
-                    n_f_new = self._scatter(edge)
-                    step_params.append(
-                        (n_f_new, x_int, y_int, TrajectoryState.SCATTER, None))
-                else:
-                    n_f_new = self._specular(n_f_int, edge)
-                    step_params.append(
-                        (n_f_new, x_int, y_int, TrajectoryState.REFLECT, None))
-
-            elif edge.layer == 2:
-                # Grounded ohmic
-                if np.random.rand() < self._p_ohmic_absorb:
-                    # Absorbed
-                    step_params.append(
-                        (n_f_int, x_int, y_int, TrajectoryState.ABSORBED, edge))
-                else:
-                    step_params.append(
-                        (n_f_int, x_int, y_int, TrajectoryState.COLLISION, None))
-
-                    if np.random.rand() < self._p_scatter:
-                        n_f_new = self._scatter(edge)
-                        step_params.append(
-                            (n_f_new, x_int, y_int, TrajectoryState.SCATTER, None))
-                    else:
-                        n_f_new = self._specular(n_f_int, edge)
-                        step_params.append(
-                            (n_f_new, x_int, y_int, TrajectoryState.REFLECT, None))
+        # Only device edge collisions are counted, ohmic collisions were not absorbed
+        count_edge = edge if layer == device_layer else None
+        if corner:
+            step_params.append(
+                (n_f_int, x_int, y_int, TrajectoryState.CCOLLISION, count_edge))
+            if self._rand() < self._p_scatter:
+                n_f_new = self._corner_scatter(edge_0, edge_1)
+                state = TrajectoryState.CSCATTER
             else:
-                # Generic ohmic
-                if np.random.rand() < self._p_ohmic_absorb:
-                    # Absorb and reemit
-                    step_params.append(
-                        (n_f_int, x_int, y_int, TrajectoryState.ABSORBED, edge))
-
-                    (x_new, y_new), reinjecting_edge = self._frame.get_inject_position(
-                        edge.layer)
-                    n_f_new = reinjecting_edge.get_injection_index()
-
-                    step_params.append(
-                        (n_f_new, x_new, y_new, TrajectoryState.INJECTING, None))
-                else:
-                    step_params.append(
-                        (n_f_int, x_int, y_int, TrajectoryState.COLLISION, None))
-
-                    if np.random.rand() < self._p_scatter:
-                        n_f_new = self._scatter(edge)
-                        step_params.append(
-                            (n_f_new, x_int, y_int, TrajectoryState.SCATTER, None))
-                    else:
-                        n_f_new = self._specular(n_f_int, edge)
-                        step_params.append(
-                            (n_f_new, x_int, y_int, TrajectoryState.REFLECT, None))
+                n_f_new = self._corner_specular(n_f, edge_0, edge_1)
+                state = TrajectoryState.CREFLECT
         else:
-            # Corner intersection
-            edge_0, x_int, y_int, _ = intersections[0]
-            edge_1, _, _, _ = intersections[1]
-
-            n_f_int = self._get_n_f_intersection(
-                n_f, [(x, y), (x_int, y_int), (x_new, y_new)])
-
-            edges = [edge_0, edge_1]
-            index = np.argmax([edge_0.layer, edge_1.layer])
-            layer = edges[index].layer
-            edge_for_count = edges[index]  # to avoid double counting
-
-            if layer == 1:
-                # Device edge
-                step_params.append(
-                    (n_f_int, x_int, y_int, TrajectoryState.CCOLLISION, edge_for_count))
-
-                if np.random.rand() < self._p_scatter:
-                    n_f_new = self._corner_scatter(edge_0, edge_1)
-                    step_params.append(
-                        (n_f_new, x_int, y_int, TrajectoryState.CSCATTER, None))
-                else:
-                    n_f_new = self._corner_specular(n_f, edge_0, edge_1, layer)
-                    step_params.append(
-                        (n_f_new, x_int, y_int, TrajectoryState.CREFLECT, None))
-
-            elif layer == 2:
-                # Grounded ohmic
-                if np.random.rand() < self._p_ohmic_absorb:
-                    step_params.append(
-                        (n_f_int, x_int, y_int, TrajectoryState.ABSORBED, edge_for_count))
-                else:
-                    step_params.append(
-                        (n_f_int, x_int, y_int, TrajectoryState.CCOLLISION, None))
-
-                    if np.random.rand() < self._p_scatter:
-                        n_f_new = self._corner_scatter(edge_0, edge_1)
-                        step_params.append(
-                            (n_f_new, x_int, y_int, TrajectoryState.CSCATTER, None))
-                    else:
-                        n_f_new = self._corner_specular(
-                            n_f, edge_0, edge_1, layer)
-                        step_params.append(
-                            (n_f_new, x_int, y_int, TrajectoryState.CREFLECT, None))
+            step_params.append(
+                (n_f_int, x_int, y_int, TrajectoryState.COLLISION, count_edge))
+            if self._rand() < self._p_scatter:
+                n_f_new = edge.get_injection_index(self._rand())
+                state = TrajectoryState.SCATTER
             else:
-                # Generic ohmic
-                if np.random.rand() < self._p_ohmic_absorb:
-                    # Absorb and reemit
-                    step_params.append(
-                        (n_f_int, x_int, y_int, TrajectoryState.CABSORBED, edge_for_count))
-
-                    (x_new, y_new), reinjecting_edge = self._frame.get_inject_position(
-                        layer)
-                    n_f_new = reinjecting_edge.get_injection_index()
-
-                    step_params.append(
-                        (n_f_new, x_new, y_new, TrajectoryState.INJECTING, None))
-
-                else:
-                    step_params.append(
-                        (n_f_int, x_int, y_int, TrajectoryState.CCOLLISION, None))
-
-                    if np.random.rand() < self._p_scatter:
-                        n_f_new = self._corner_scatter(edge_0, edge_1)
-                        step_params.append(
-                            (n_f_new, x_int, y_int, TrajectoryState.CSCATTER, None))
-                    else:
-                        n_f_new = self._corner_specular(
-                            n_f, edge_0, edge_1, layer)
-                        step_params.append(
-                            (n_f_new, x_int, y_int, TrajectoryState.CREFLECT, None))
+                n_f_new = self._specular(n_f_int, edge)
+                state = TrajectoryState.REFLECT
+        step_params.append((n_f_new, x_int, y_int, state, None))
 
         return step_params, line_crosses
 
     def _update_position(self, n_f_in, x_in, y_in):
-        [x_out, y_out] = [x_in, y_in] + n_f_in[1] * \
-            self._bandstructure.dr[:, n_f_in[0]]
-        n_f_out = ((n_f_in[0] + 1) % (np.shape(self._bandstructure.dr)[1]), 1)
+        idx, frac = n_f_in
+        x_out = x_in + frac*self._dr_x[idx]
+        y_out = y_in + frac*self._dr_y[idx]
+        n_f_out = ((idx + 1) % self._nk, 1)
         return n_f_out, x_out, y_out
 
+    def _get_r(self, n_f):
+        '''
+        Returns the real space position along the Fermi surface trajectory for the state n_f
+        '''
+        idx, frac = n_f
+        return (self._r_T[idx, 0] + (1-frac)*self._dr_x[idx],
+                self._r_T[idx, 1] + (1-frac)*self._dr_y[idx])
+
     def _specular(self, n_f, edge):
+        return self._specular_from_line(n_f, edge.xs[0] - edge.xs[1], edge.ys[0] - edge.ys[1])
 
-        fermi_intersections = self._get_fermi_intersections(n_f, edge)
+    def _specular_from_line(self, n_f, xdel, ydel):
+        '''
+        Specular reflection of n_f off a line along the direction (xdel, ydel)
+        '''
+        fermi_intersections = self._get_fermi_intersections_from_line(
+            n_f, xdel, ydel)
 
-        line_x1, line_y1 = (
-            self._bandstructure.r[0][n_f[0]], self._bandstructure.r[1][n_f[0]]) + (1-n_f[1])*self._bandstructure.dr[:, n_f[0]]
+        line_x1, line_y1 = self._get_r(n_f)
 
-        # pythagoras on each segment to check which one is the closest
+        # pythagoras on each segment to check which one is the closest, squared as only the order matters
         valid_reflection = False
         min_distance = float('inf')
         for testing_point in fermi_intersections:
             if testing_point[0] != n_f[0]:
                 valid_reflection = True
 
-                segment_x3 = self._bandstructure.r[0][testing_point[0]]
-                segment_y3 = self._bandstructure.r[1][testing_point[0]]
-                this_distance = np.sqrt(
-                    np.power(line_x1-segment_x3, 2)+(np.power(line_y1-segment_y3, 2)))
+                segment_x3 = self._r_T[testing_point[0], 0]
+                segment_y3 = self._r_T[testing_point[0], 1]
+                this_distance = (line_x1-segment_x3)**2 + \
+                    (line_y1-segment_y3)**2
                 if this_distance < min_distance:
                     min_distance = this_distance
                     reflected_state = testing_point
@@ -334,15 +806,15 @@ class Simulation:
             return reflected_state
 
     def _get_fermi_intersections(self, n_f, edge):
-        xdel = edge.xs[0] - edge.xs[1]
-        ydel = edge.ys[0] - edge.ys[1]
+        return self._get_fermi_intersections_from_line(n_f, edge.xs[0] - edge.xs[1], edge.ys[0] - edge.ys[1])
+
+    def _get_fermi_intersections_from_line(self, n_f, xdel, ydel):
         # get the slope of the edge
         line_slope = float('inf')
         if xdel != 0:
             line_slope = ydel/xdel
 
-        line_x1, line_y1 = (
-            self._bandstructure.r[0][n_f[0]], self._bandstructure.r[1][n_f[0]]) + (1-n_f[1])*self._bandstructure.dr[:, n_f[0]]
+        line_x1, line_y1 = self._get_r(n_f)
 
         if line_slope != float('inf'):
             line_x2 = line_x1 + 100.0
@@ -351,31 +823,38 @@ class Simulation:
             line_x2 = line_x1
             line_y2 = line_y1 + 100.0
 
-        fermi_intersections = list()
-        # go through all the segments and try to find the intersecting point
-        #   if an intersection exists, add it to fermi_intersections
-        for segment_index, (segment_x3, segment_y3) in enumerate(zip(self._bandstructure.r[0][:-1], self._bandstructure.r[1][:-1])):
-            # recall that r is closed in that the first and last point are the same, so we don't want to double check
-
-            segment_x4 = segment_x3 + self._bandstructure.dr[0][segment_index]
-            segment_y4 = segment_y3 + self._bandstructure.dr[1][segment_index]
-
-            intersection_x, intersection_y = self._calc_int_of_two_lines([(segment_x3, segment_y3), (segment_x4, segment_y4)],
-                                                                         [(line_x1, line_y1), (line_x2, line_y2)])
-
-            if not np.isnan(intersection_x) and not np.isnan(intersection_y):
-                if (segment_x3 <= intersection_x and intersection_x <= segment_x4) or (segment_x4 <= intersection_x and intersection_x <= segment_x3):
-                    if (segment_y3 <= intersection_y and intersection_y <= segment_y4) or (segment_y4 <= intersection_y and intersection_y <= segment_y3):
-                        segment_factor = 1 - (
-                            intersection_y - segment_y3) / (segment_y4 - segment_y3)
-                        fermi_intersections.append(
-                            (segment_index, segment_factor))
+        # intersect the line with all segments at once
+        # recall that r is closed in that the first and last point are the same, so we don't want to double check
+        segment_x3 = self._bandstructure.rx0
+        segment_y3 = self._bandstructure.ry0
+        segment_x4 = self._bandstructure.rx1
+        segment_y4 = self._bandstructure.ry1
+
+        # https://en.wikipedia.org/wiki/Line%E2%80%93line_intersection, as in _calc_int_of_two_lines
+        denominator = (segment_x3 - segment_x4)*(line_y1 - line_y2) - \
+            (segment_y3 - segment_y4)*(line_x1 - line_x2)
+        # Segments parallel to the line divide by zero and are dropped by the in-segment mask
+        with np.errstate(divide='ignore', invalid='ignore'):
+            intersection_x = ((segment_x3*segment_y4 - segment_y3*segment_x4)*(line_x1 - line_x2) - (segment_x3 - segment_x4)
+                              * (line_x1*line_y2 - line_y1*line_x2))/denominator
+            intersection_y = ((segment_x3*segment_y4 - segment_y3*segment_x4)*(line_y1 - line_y2) - (segment_y3 - segment_y4)
+                              * (line_x1*line_y2 - line_y1*line_x2))/denominator
+
+            # keep the intersections that fall within their segment
+            in_segment = (denominator != 0) & \
+                (np.minimum(segment_x3, segment_x4) <= intersection_x) & (intersection_x <= np.maximum(segment_x3, segment_x4)) & \
+                (np.minimum(segment_y3, segment_y4) <= intersection_y) & (
+                    intersection_y <= np.maximum(segment_y3, segment_y4))
+            segment_indices = np.flatnonzero(in_segment)
+
+            segment_factors = 1 - (intersection_y[segment_indices] - segment_y3[segment_indices]) / \
+                (segment_y4[segment_indices] - segment_y3[segment_indices])
+
+        fermi_intersections = [(int(segment_index), segment_factor)
+                               for segment_index, segment_factor in zip(segment_indices, segment_factors)]
         return fermi_intersections
 
-    def _scatter(self, edge):
-        return edge.get_injection_index()
-
-    def _corner_specular(self, n_f, edge_0, edge_1, layer):
+    def _corner_specular(self, n_f, edge_0, edge_1):
         # first we get the intersection of the 2 edge lines
         # with that point as a center, we trace a circle that cuts the 2 edge lines in 2 points each (new_x, new_y)
         # for each one of the 2 pairs, we check the distance to the particle point to determine the quadrant
@@ -400,10 +879,8 @@ class Simulation:
             intersection_y = ((x1*y2 - y1*x2) * (y3 - y4) -
                               (y1 - y2) * (x3*y4 - y3*x4)) / denominator
         # distance bw one edge point and the intersection
-        distance_a = np.sqrt(np.power(x1 - intersection_x,
-                                      2) + np.power(y1 - intersection_y, 2))
-        distance_b = np.sqrt(np.power(x2 - intersection_x,
-                                      2) + np.power(y2 - intersection_y, 2))
+        distance_a = hypot(x1 - intersection_x, y1 - intersection_y)
+        distance_b = hypot(x2 - intersection_x, y2 - intersection_y)
         # the proportion that needs to be applied to get to a random distance of 1000
         proportion_a = 1000 / distance_a
         proportion_b = 1000 / distance_b
@@ -422,18 +899,14 @@ class Simulation:
         new_x4 = intersection_x - new_x_shift_b
         new_y4 = intersection_y - new_y_shift_b
         # the particle point
-        current_x = self._bandstructure.r[0][n_f[0]]
-        current_y = self._bandstructure.r[1][n_f[0]]
+        current_x = self._r_T[n_f[0], 0]
+        current_y = self._r_T[n_f[0], 1]
         # from each edge line decide which one of the 2 points is the nearest to the particle
-        # this will give us the quadrant / triangle we are in
-        distance_to_new_1 = np.sqrt(
-            np.power(current_x - new_x1, 2) + np.power(current_y - new_y1, 2))
-        distance_to_new_2 = np.sqrt(
-            np.power(current_x - new_x2, 2) + np.power(current_y - new_y2, 2))
-        distance_to_new_3 = np.sqrt(
-            np.power(current_x - new_x3, 2) + np.power(current_y - new_y3, 2))
-        distance_to_new_4 = np.sqrt(
-            np.power(current_x - new_x4, 2) + np.power(current_y - new_y4, 2))
+        # this will give us the quadrant / triangle we are in (squared distances suffice)
+        distance_to_new_1 = (current_x - new_x1)**2 + (current_y - new_y1)**2
+        distance_to_new_2 = (current_x - new_x2)**2 + (current_y - new_y2)**2
+        distance_to_new_3 = (current_x - new_x3)**2 + (current_y - new_y3)**2
+        distance_to_new_4 = (current_x - new_x4)**2 + (current_y - new_y4)**2
         quadrant_x1 = new_x1
         quadrant_y1 = new_y1
         if distance_to_new_1 > distance_to_new_2:
@@ -459,79 +932,101 @@ class Simulation:
         virtual_edge_x2 = -1000.0  # random number to get another point
         virtual_edge_y2 = ((virtual_edge_x2 - intersection_x) *
                            perpendicular_slope) / intersection_y
-        virtual_edge = Edge(virtual_edge_x1, virtual_edge_y1,
-                            virtual_edge_x2, virtual_edge_y2, layer)
-        return self._specular(n_f, virtual_edge)
+        # only the direction of the virtual edge matters, so skip building an Edge for it
+        return self._specular_from_line(n_f, virtual_edge_x1 - virtual_edge_x2, virtual_edge_y1 - virtual_edge_y2)
 
     def _corner_scatter(self, edge_0, edge_1):
-        # Convolve the probility distributions
-        in_prob = (edge_0.in_prob*edge_1.in_prob) / \
-            np.sum(edge_0.in_prob*edge_1.in_prob)
-        cum_prob = np.cumsum(in_prob)
-        return Edge.compute_injection_index(cum_prob)
-
-    def _get_sorted_intersections(self, step_coords):
-        x = step_coords[0][0]
-        y = step_coords[0][1]
-        intersections = self._get_intersections(step_coords)
-
-        def compute_s(intersection):
-            edge, x_int, y_int = intersection
-            S = np.sqrt((x_int - x)**2 + (y_int - y)**2)
-            return (edge, x_int, y_int, S)
-
-        intersections_with_S = map(compute_s, intersections)
-        if len(intersections) < 2:
-            return list(intersections_with_S)
+        key = (edge_0.index, edge_1.index)
+        cum_prob = self._corner_cum_probs.get(key)
+        if cum_prob is None:
+            # Convolve the probility distributions
+            in_prob = (edge_0.in_prob*edge_1.in_prob) / \
+                np.sum(edge_0.in_prob*edge_1.in_prob)
+            cum_prob = np.cumsum(in_prob)
+            self._corner_cum_probs[key] = cum_prob
+        return Edge.compute_injection_index(cum_prob, self._rand())
+
+    def _get_sorted_intersections(self, x, y, x_del, y_del):
+        '''
+        Returns the intersections of the step with the edges as (edge, x_int, y_int, S), ordered
+        by the distance S from the start of the step
+        Only the two nearest intersections are returned, as nothing beyond a corner is inspected
+        '''
+        idx, xs_int, ys_int = self._get_intersection_arrays(x, y, x_del, y_del)
+        # The squared distance is enough to pick the two nearest, but S itself has to be the
+        # rounded sqrt, as squaring does not keep the exact ties _step_position detects corners by
+        S2 = (xs_int - x)**2 + (ys_int - y)**2
+
+        n = len(S2)
+        if n > 2:
+            order = np.argpartition(S2, 1)[:2]
         else:
-            return sorted(intersections_with_S, key=lambda intersections: intersections[3])
+            order = np.arange(n)
+        S = np.sqrt(S2[order])
+        if n > 1 and (S[1] < S[0] or (S[1] == S[0] and order[1] < order[0])):
+            order = order[::-1]
+            S = S[::-1]
+
+        return [(self._frame.edges[idx[i]], xs_int[i], ys_int[i], S_i) for i, S_i in zip(order, S)]
 
-    def _get_intersections(self, step_coords, bias=True):
+    def _get_intersections(self, x, y, x_del, y_del, bias=True):
         '''
-        Given a step, check all the edges in the _frame to see if the step crosses
+        Given a step from (x, y) by (x_del, y_del), check all the edges in the _frame to see if the step crosses
         Return True if it does and a list of crossed edges
         '''
-        x = step_coords[0][0]
-        y = step_coords[0][1]
-        x_new = step_coords[1][0]
-        y_new = step_coords[1][1]
+        idx, xs_int, ys_int = self._get_intersection_arrays(
+            x, y, x_del, y_del, bias)
+        return [(self._frame.edges[i], x_int, y_int) for i, x_int, y_int in zip(idx, xs_int, ys_int)]
 
-        x_del = x_new - x
-        y_del = y_new - y
-        x01 = -x_del
-        y01 = -y_del
-        x02 = x - self._frame.px0
-        y02 = y - self._frame.py0
-
-        intersections = []
-        ts, us = self.get_ts_us(x01, x02, self._frame.x23,
-                                y01, y02, self._frame.y23)
-
-        for i, (t, u) in enumerate(zip(ts, us)):
-            if 0 <= t and t <= 1 and 0 <= u and u <= 1:
-                edge = self._frame.edges[i]
-                if x_del * edge.normal[0] + y_del * edge.normal[1] < 0:
-                    x_int = edge.xs[0] + u*(edge.xs[1] - edge.xs[0])
-                    y_int = edge.ys[0] + u*(edge.ys[1] - edge.ys[0])
-                    if x_int != x or y_int != y:
-                        if bias:
-                            bias_vector = 1E-10 * \
-                                np.array([(x_new-x), (y_new-y)]) / \
-                                np.sqrt((x_new-x)**2 + (y_new-y)**2)
-                            intersections.append(
-                                (edge, x_int - bias_vector[0], y_int - bias_vector[1]))
-                        else:
-                            intersections.append((edge, x_int, y_int))
-        return intersections
-
-    def get_ts_us(self, x01, x02, x23, y01, y02, y23):
+    def _get_intersection_arrays(self, x, y, x_del, y_del, bias=True):
+        '''
+        Array form of _get_intersections
+        Returns the indices of the crossed edges and the coordinates of the intersections
+        '''
+        # Only edges that are crossed by the step while moving against their
+        # normal survive, typically zero to two of them
+        idx, u_sel = self._get_hits(
+            x, y, x_del, y_del, self._frame, True, self._frame_tree)
+        xs_int = self._frame.px0[idx] + u_sel*self._frame.dx[idx]
+        ys_int = self._frame.py0[idx] + u_sel*self._frame.dy[idx]
+
+        keep = (xs_int != x) | (ys_int != y)
+        idx, xs_int, ys_int = idx[keep], xs_int[keep], ys_int[keep]
+
+        if bias and len(idx):
+            # step back from the edge by 1E-10 along the step direction
+            inv_len = 1E-10 / hypot(x_del, y_del)
+            xs_int = xs_int - x_del*inv_len
+            ys_int = ys_int - y_del*inv_len
+        return idx, xs_int, ys_int
+
+    def _get_batch_hits(self, x, y, x_del, y_del, lines, oriented):
+        '''
+        Batched version of _get_hits for arrays of steps
+        Returns a boolean array of shape (steps, segments) marking which segments each step crosses
+        '''
+        x01 = -x_del[:, None]
+        y01 = -y_del[:, None]
+        x02 = x[:, None] - lines.px0
+        y02 = y[:, None] - lines.py0
+        ts, us = self.get_ts_us(x01, x02, lines.x23, y01, y02, lines.y23)
+
+        mask = (ts >= 0) & (ts <= 1) & (us >= 0) & (us <= 1)
+        if oriented:
+            mask &= x_del[:, None]*lines.nx + y_del[:, None]*lines.ny < 0
+        return mask
+
+    @staticmethod
+    def get_ts_us(x01, x02, x23, y01, y02, y23):
         '''
         calculate useful quantities for finding intersection of two line segments
         following notation from here but zero indexed: https://en.wikipedia.org/wiki/Line%E2%80%93line_intersection
+        Segments parallel to the step divide by zero, giving inf or nan which fail the range checks
         '''
-        with np.errstate(divide='ignore'):
-            ts = (x02*y23 - y02*x23) / (x01*y23 - y01*x23)
-            us = -(x01*y02 - y01*x02) / (x01*y23 - y01*x23)
+        denominator = x01*y23 - y01*x23
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ts = (x02*y23 - y02*x23) / denominator
+            us = -(x01*y02 - y01*x02) / denominator
         return ts, us
 
     def _get_n_f_intersection(self, n_f, coords):
@@ -544,31 +1039,57 @@ class Simulation:
         y_int = coords[1][1]
         x_new = coords[2][0]
         y_new = coords[2][1]
-        f = n_f[1] * (1 - np.sqrt(((x_int - x)**2 + (y_int - y)**2) /
-                                  ((x_new - x)**2 + (y_new - y)**2)))
+        f = n_f[1] * (1 - hypot(x_int - x, y_int - y) /
+                      hypot(x_new - x, y_new - y))
         return (n_f[0], f)
 
-    def _get_crosses(self, step_coords):
-        x = step_coords[0][0]
-        y = step_coords[0][1]
-        x_new = step_coords[1][0]
-        y_new = step_coords[1][1]
+    def _get_crosses(self, x, y, x_del, y_del):
+        idx, _ = self._get_hits(
+            x, y, x_del, y_del, self._ohmic_lines, False, self._ohmic_lines_tree)
+        return [self._ohmic_lines.lines_as_edges[i] for i in idx]
 
-        x_del = x_new - x
-        y_del = y_new - y
-        x01 = -x_del
-        y01 = -y_del
-        x02 = x - self._ohmic_lines.px0
-        y02 = y - self._ohmic_lines.py0
-
-        crosses = []
-        ts, us = self.get_ts_us(x01, x02, self._ohmic_lines.x23,
-                                y01, y02, self._ohmic_lines.y23)
-        for i, (t, u) in enumerate(zip(ts, us)):
-            if 0 <= t and t <= 1 and 0 <= u and u <= 1:
-                line = self._ohmic_lines.lines_as_edges[i]
-                crosses.append(line)
-        return crosses
+    def _get_hits(self, x, y, x_del, y_del, lines, oriented, tree=None):
+        '''
+        Returns the indices of the segments in lines (a Frame or OhmicLines) crossed by the step
+        along with the fractional position u of each crossing along its segment
+        If an STR tree over the segments is given, only those overlapping the bounding box of
+        the step are tested. Without one the NumPy path applies the same bounding box test
+        directly once there are at least AABB_MIN_EDGES segments
+        '''
+        px0, py0, x23, y23, nx, ny = lines.px0, lines.py0, lines.x23, lines.y23, lines.nx, lines.ny
+        candidates = None
+        if tree is not None or (not HAS_NUMBA and len(px0) >= AABB_MIN_EDGES):
+            x_new = x + x_del
+            y_new = y + y_del
+            x_lo, x_hi = min(x, x_new), max(x, x_new)
+            y_lo, y_hi = min(y, y_new), max(y, y_new)
+            if tree is not None:
+                candidates = np.sort(tree.query(box(x_lo, y_lo, x_hi, y_hi)))
+            else:
+                candidates = np.flatnonzero((lines.xmin <= x_hi) & (lines.xmax >= x_lo) &
+                                            (lines.ymin <= y_hi) & (lines.ymax >= y_lo))
+            px0, py0, x23, y23, nx, ny = px0[candidates], py0[candidates], x23[candidates], \
+                y23[candidates], nx[candidates], ny[candidates]
+
+        if HAS_NUMBA:
+            idx, us = _edge_hits_kernel(
+                x, y, x_del, y_del, px0, py0, x23, y23, nx, ny, oriented)
+        else:
+            x01 = -x_del
+            y01 = -y_del
+            x02 = x - px0
+            y02 = y - py0
+            ts, us = self.get_ts_us(x01, x02, x23, y01, y02, y23)
+
+            mask = (ts >= 0) & (ts <= 1) & (us >= 0) & (us <= 1)
+            if oriented:
+                mask &= x_del*nx + y_del*ny < 0
+            idx = np.flatnonzero(mask)
+            us = us[idx]
+
+        if candidates is not None:
+            idx = candidates[idx]
+        return idx, us
 
     def _calc_int_of_two_lines(self, line0_cords, line1_cords):
         '''
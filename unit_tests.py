@@ -40,7 +40,7 @@ class TestAll(unittest.TestCase):
     simulation = mcs.Simulation(tef_frame, k, 0, 4)
     edge0 = Edge(2, 4, 7, 3, 0)
     edge1 = Edge(4, 2, 4, 8, 0)
-    n_f_out = simulation._corner_specular([4, 0.3], edge0, edge1, 0)
+    n_f_out = simulation._corner_specular([4, 0.3], edge0, edge1)
     self.assertEqual(n_f_out, (985, 0.3081393959289981))
 
   def test_simulation_get_ts_us(self):
@@ -61,5 +61,97 @@ class TestAll(unittest.TestCase):
     self.assertEqual(intersections[0], (12, 0.5000000000003393))
     self.assertEqual(intersections[1], (340, 0.31319998953334305))
 
+  def test_simulation_vertex_step_is_corner(self):
+    # A step through the vertex (0, -4.5) whose two intersections tie in distance, but not
+    # in squared distance
+    tef_frame = caustic_frame.Frame('geo/tef.dxf')
+    k = delafossite()
+    simulation = mcs.Simulation(tef_frame, k, 0, 4, p_ohmic_absorb=0)
+    idx, a = 580, 0.49999999999999994
+    x = 0.0 - a*simulation._dr_x[idx]
+    y = -4.5 - a*simulation._dr_y[idx]
+    step_params, _ = simulation._step_position((idx, 1), x, y)
+    self.assertEqual(step_params[0][3], mcs.TrajectoryState.CCOLLISION)
+    self.assertIn(step_params[1][3], (mcs.TrajectoryState.CREFLECT, mcs.TrajectoryState.CSCATTER))
+
+  def test_simulation_strtree_intersections(self):
+    tef_frame = caustic_frame.Frame('geo/tef.dxf')
+    k = delafossite()
+    simulation = mcs.Simulation(tef_frame, k, 0, 4)
+    min_edges = mcs.STRTREE_MIN_EDGES
+    mcs.STRTREE_MIN_EDGES = 0
+    try:
+      simulation_tree = mcs.Simulation(tef_frame, k, 0, 4)
+    finally:
+      mcs.STRTREE_MIN_EDGES = min_edges
+    self.assertIsNotNone(simulation_tree._frame_tree)
+
+    rng = np.random.RandomState(0)
+    for x, y, x_new, y_new in rng.uniform(-12, 12, size=(200, 4)):
+      expected = [(edge.start, x_int, y_int) for edge, x_int, y_int in simulation._get_intersections(x, y, x_new - x, y_new - y)]
+      actual = [(edge.start, x_int, y_int) for edge, x_int, y_int in simulation_tree._get_intersections(x, y, x_new - x, y_new - y)]
+      self.assertEqual(expected, actual)
+
+  def test_simulation_aabb_intersections(self):
+    tef_frame = caustic_frame.Frame('geo/tef.dxf')
+    k = delafossite()
+    simulation = mcs.Simulation(tef_frame, k, 0, 4)
+    has_numba, min_edges = mcs.HAS_NUMBA, mcs.AABB_MIN_EDGES
+    mcs.HAS_NUMBA = False
+    try:
+      rng = np.random.RandomState(0)
+      for x, y, x_new, y_new in rng.uniform(-12, 12, size=(200, 4)):
+        mcs.AABB_MIN_EDGES = len(tef_frame.edges) + 1
+        expected = [(edge.start, x_int, y_int) for edge, x_int, y_int in simulation._get_intersections(x, y, x_new - x, y_new - y)]
+        mcs.AABB_MIN_EDGES = 0
+        actual = [(edge.start, x_int, y_int) for edge, x_int, y_int in simulation._get_intersections(x, y, x_new - x, y_new - y)]
+        self.assertEqual(expected, actual)
+    finally:
+      mcs.HAS_NUMBA, mcs.AABB_MIN_EDGES = has_numba, min_edges
+
+  def test_bandstructure_injection_prob_batch(self):
+    bandstructure = Bandstructure(delafossite(), 0, 4)
+    angles = np.linspace(-np.pi, np.pi, 9)
+    in_probs, cum_probs = bandstructure.calculate_injection_prob_batch(angles)
+    self.assertEqual(in_probs.shape, (len(angles), len(bandstructure.dr[0])))
+
+    # Reference: the original per-edge formula
+    S = np.sqrt(bandstructure.dr[0]**2 + bandstructure.dr[1]**2)
+    S_max = np.max(S)
+    theta = np.arctan2(bandstructure.dr[1], bandstructure.dr[0])
+    for angle, in_prob, cum_prob in zip(angles, in_probs, cum_probs):
+      prob = np.cos(theta - angle) * S/S_max
+      prob = [0 if p < 0 else p for p in prob]
+      prob = prob/np.sum(prob)
+      self.assertTrue(np.array_equal(in_prob, prob))
+      self.assertTrue(np.array_equal(cum_prob, np.cumsum(prob)))
+
+  def test_compute_injection_index(self):
+    cum_prob = np.cumsum([0.1, 0.0, 0.3, 0.6])
+    self.assertEqual(Edge.compute_injection_index(cum_prob, 0.05), (0, 0.5))
+    self.assertEqual(Edge.compute_injection_index(cum_prob, 0.1)[0], 2)
+    self.assertEqual(Edge.compute_injection_index(cum_prob, 0.7)[0], 3)
+    self.assertEqual(Edge.compute_injection_index(cum_prob, 1.0)[0], 3)
+
+    # States facing away from the edge have zero probability, leaving a flat tail
+    cum_prob = np.cumsum([0.1, 0.3, 0.6, 0.0, 0.0])
+    for r in (cum_prob[-1], 1.0 + 1E-12):
+      n, f = Edge.compute_injection_index(cum_prob, r)
+      self.assertEqual((n, f), (2, 0.0))
+
+  def test_frame_contains_point(self):
+    from shapely.geometry import Point
+    tef_frame = caustic_frame.Frame('geo/tef.dxf')
+    rng = np.random.RandomState(0)
+    points = [tuple(point) for point in rng.uniform(-12, 12, size=(500, 2))]
+    # Vertices and points along the edges, including the horizontal ones
+    for edge in tef_frame.edges:
+      for t in (0, 0.25, 1/3, 0.5):
+        points.append(edge.interpolate_frac_positon(t))
+    for x, y in points:
+      self.assertEqual(tef_frame.contains_point(x, y), tef_frame.body.intersects(Point(x, y)))
+    for edge in tef_frame.edges:
+      self.assertTrue(tef_frame.contains_point(*edge.start))
+
 if __name__ == '__main__':
   unittest.main()